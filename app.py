@@ -1,354 +1,735 @@
-from flask import Flask, request, jsonify
-from openai import OpenAI
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import SystemMessage, HumanMessage
-from flask_cors import CORS
+from quart import Quart, request, jsonify, make_response
+from quart.json.provider import DefaultJSONProvider
+from quart_cors import cors
+from quart_rate_limiter import RateLimiter, rate_limit
+from quart_rate_limiter.redis_store import RedisStore
+from quart_rate_limiter.store import MemoryStore
+from brotli_asgi import BrotliMiddleware
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, APITimeoutError, InternalServerError, RateLimitError
+from pydantic import BaseModel, NonNegativeFloat, NonNegativeInt, ValidationError, conint, conlist, constr, field_validator
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+from collections import defaultdict
+from contextlib import aclosing
+from datetime import timedelta
+from typing import Literal, Union
+import asyncio
+import atexit
+import hashlib
+import httpx
+import logging
+import logging.handlers
 import os
-import json
-
-# Initialize Flask app
-app = Flask(__name__)
+import orjson
+import queue
+import re
+import textwrap
+
+class JsonFormatter(logging.Formatter):
+    """Format the log records as JSON lines, including the fields passed in extra"""
+    RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name, "message": record.getMessage()}
+        entry.update({key: value for key, value in vars(record).items() if key not in self.RECORD_ATTRIBUTES})
+        return orjson.dumps(entry, default=str).decode()
+
+# Log through a queue, so the formatting and the writes to stderr happen on the listener thread instead of the request path
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(JsonFormatter())
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+logger.propagate = False
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Parse requests and serialize responses with orjson, a lot faster than json on the itinerary payloads"""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_INDENT_2 if kwargs.get("indent") else 0
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+# Initialize Quart app (async Flask API, so the OpenAI calls can run concurrently)
+app = Quart(__name__)
+app.json = OrjsonProvider(app)
 
 # Enable CORS
-CORS(app)
+app = cors(app)
+
+# Compress the JSON responses with Brotli, or gzip for the clients without it; the SSE stream
+# is left uncompressed so each event reaches the client as soon as it's sent. Quart sends every
+# body as a stream, so the middleware compresses every response, whatever its size
+app.asgi_app = BrotliMiddleware(
+    app.asgi_app,
+    gzip_fallback=True,
+    excluded_handlers=[r"^/generate_itinerary/stream$"]
+)
+
+class FallbackRedisStore(RedisStore):
+    """Rate limits stored in Redis, falling back to the worker's own counts while Redis is unavailable,
+    the same way the cache treats a Redis error as a miss rather than failing the request"""
+
+    def __init__(self, address):
+        super().__init__(address)
+        self.fallback = MemoryStore()
 
-# Configure LangChain with OpenAI API key
-chat_model = ChatOpenAI(
-    model="gpt-4",
-    temperature=0.7,  # Increased for more creative responses
-    openai_api_key=os.getenv("OPENAI_API_KEY")
+    async def get(self, key, default):
+        try:
+            return await super().get(key, default)
+        except RedisError as e:
+            logger.warning("Redis error", extra={"error": str(e)})
+            return await self.fallback.get(key, default)
+
+    async def set(self, key, tat):
+        try:
+            await super().set(key, tat)
+        except RedisError as e:
+            logger.warning("Redis error", extra={"error": str(e)})
+            await self.fallback.set(key, tat)
+
+async def client_addr_key():
+    """Rate limit key of the client, its connection's address rather than the X-Forwarded-For header it controls;
+    the Uvicorn workers only take the address from that header when the proxy sending it is in FORWARDED_ALLOW_IPS"""
+    return request.remote_addr
+
+# Rate limit each client IP, shared by all the workers when Redis is available; without it, or while it's
+# unreachable, each worker counts on its own, so a client gets up to the number of workers times the limits below
+rate_limiter = RateLimiter(
+    app,
+    key_function=client_addr_key,
+    store=FallbackRedisStore(os.getenv("REDIS_URL")) if os.getenv("REDIS_URL") else None
 )
 
-def create_initial_itinerary_structure(origin, days, destinations, budget, stayPref, currency="USD", groupSize=2, 
-                    comfortLevel="moderate", theme="general", additionalInfo=""):
-    return {
-        "title": f"{days}-Day Trip from {origin} to {destinations}" if theme == "general" else f"{days}-Day {theme} Trip from {origin} to {destinations}",
-        "details": {
-            "budget": budget,
-            "currency": currency,
-            "groupSize": groupSize,
-            "comfortLevel": comfortLevel,
-            "StayPref": stayPref,
-            "theme": theme,
-            "additionalInfo": additionalInfo
-        }
-    }
+# Shared connection pool, so the TCP/TLS sessions to OpenAI are reused across requests,
+# with HTTP/2 so the concurrent calls are multiplexed over the same connections
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+    timeout=httpx.Timeout(60.0, connect=5.0)
+)
 
-def populate_daily_activities(trip_details):
-    """Generate detailed daily activities using the LLM"""
-    days = trip_details["details"].get("days", 5)
-    prompt = f"""
-    Create a detailed day-by-day itinerary for a {days}-day trip with the costs calculation:
-    - From: {trip_details['details'].get('origin')}
-    - To: {trip_details['details'].get('destinations')}
-    - Budget: {trip_details['details'].get('budget')} {trip_details['details'].get('currency')}
-    - Stay Preference: {trip_details['details'].get('stayPref')}
-    - Group Size: {trip_details['details'].get('groupSize')}
-    - Comfort Level: {trip_details['details'].get('comfortLevel')}
-    - Theme: {trip_details['details'].get('theme')}
-    - Additional Info: {trip_details['details'].get('additionalInfo')}
+# Configure OpenAI client with API key, shared by the chat and image calls; the retries are handled by openai_retrying
+client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=http_client,
+    max_retries=0
+)
 
-    For each day, provide:
-    1. Morning activities, MUST provide transportation details for each activity(for example, taxi to Airbnb address), includes estimated transportation time; if theme is not general and the activity is related to the theme, MUST provide the details of how the activities related to the theme.
-    2. Afternoon activities, MUST provide transportation details for each activity(for example, taxi to Airbnb address), includes estimated transportation time; if theme is not general and the activity is related to the theme, MUST provide the details of how the activities related to the theme.
-    3. Evening activities, MUST provide transportation details for each activity(for example, subway to dinning address), includes estimated transportation time; if theme is not general and the activity is related to the theme, MUST provide the details of how the activities related to the theme.
-    4. Recommended restaurants/meals
-    5. Estimated costs, must includes stay(hotel/airbnb) costs, transportation costs, meal costs and miscellaneous costs. 
+# Bound the concurrent OpenAI calls of each worker, so a spike of requests doesn't blow through the rate limits
+llm_semaphore = asyncio.Semaphore(32)
+image_semaphore = asyncio.Semaphore(8)
+
+def is_transient_openai_error(error):
+    """Whether the OpenAI call failed transiently, the same errors the SDK's own retries cover"""
+    if isinstance(error, (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code in (408, 409)
+
+def openai_retrying():
+    """Retry the OpenAI calls failing transiently (rate limits, timeouts, connection and server errors), with exponential backoff and jitter"""
+    return AsyncRetrying(
+        stop=stop_after_attempt(5),
+        wait=wait_random_exponential(min=1, max=30),
+        retry=retry_if_exception(is_transient_openai_error),
+        reraise=True
+    )
 
-    After day-by-day itinerary, also provide:
-    1. Estimated Stay Total Costs
-    2. Estimated Transportation Total Costs
-    3. Estimated Meal Total Costs
-    4. Estimated miscellaneous Costs
-    5. Estimated Trip Total Costs
+# Cache of generated itineraries and images, disabled when REDIS_URL is not set
+redis_client = Redis.from_url(os.getenv("REDIS_URL")) if os.getenv("REDIS_URL") else None
+ITINERARY_CACHE_TTL = 7 * 24 * 60 * 60
+IMAGE_CACHE_TTL = 50 * 60  # DALL-E image URLs expire after an hour
 
-    Return the response as a JSON array where each element has 'day' and 'details' keys, the response also includes a 'costs' key for trip total costs details.
-    """
+# The preview image is a lot faster and cheaper to generate, the HD one is only generated on demand
+IMAGE_QUALITIES = {
+    "preview": {"model": "dall-e-2", "size": "512x512"},
+    "hd": {"model": "dall-e-3", "size": "1024x1024", "quality": "hd"}
+}
 
-    messages = [
-        SystemMessage(content="You are a knowledgeable travel planner. Create detailed, realistic daily itineraries that fit the budget and preferences specified."),
-        HumanMessage(content=prompt)
-    ]
+@app.after_serving
+async def close_client():
+    await client.close()
+    if redis_client is not None:
+        await redis_client.aclose()
 
-    functions = [{
-        "name": "create_daily_itinerary",
-        "description": "Create detailed daily itinerary",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "itinerary": {
-                    "type": "array",
-                    "items": {
+async def cache_get(key):
+    """Return the cached value of the key, or None if it isn't cached"""
+    if redis_client is None:
+        return None
+
+    try:
+        value = await redis_client.get(key)
+    except RedisError as e:
+        logger.warning("Redis error", extra={"error": str(e)})
+        return None
+
+    return orjson.loads(value) if value else None
+
+async def cache_set(key, value, ttl):
+    """Cache the value of the key for ttl seconds"""
+    if redis_client is None:
+        return
+
+    try:
+        await redis_client.set(key, orjson.dumps(value), ex=ttl)
+    except RedisError as e:
+        logger.warning("Redis error", extra={"error": str(e)})
+
+def trip_cache_key(trip_details):
+    """Cache key of the trip plan, identical for requests which only differ in casing, spacing or budget cents"""
+    details = dict(trip_details["details"])
+    details["destinations"] = details["destinations"].lower()
+    details["additionalInfo"] = details["additionalInfo"].strip()
+    try:
+        details["budget"] = round(float(details["budget"]))
+    except (TypeError, ValueError):
+        details["budget"] = str(details["budget"]).strip()
+
+    # Versioned with the shape of the cached plan, so plans cached in an older shape aren't served
+    return "itinerary:v2:" + hashlib.sha256(orjson.dumps(details, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+async def create_chat_completion(**kwargs):
+    """Create a chat completion, retrying on transient errors"""
+    async for attempt in openai_retrying():
+        with attempt:
+            raw_response = await client.chat.completions.with_raw_response.create(**kwargs)
+
+    logger.info("OpenAI rate limit", extra={"remaining_requests": raw_response.headers.get("x-ratelimit-remaining-requests")})
+    return raw_response.parse()
+
+async def call_tool(messages, tools):
+    """Call the chat model, forcing it to answer with the first tool; returns the raw tool arguments"""
+    async with llm_semaphore:
+        response = await create_chat_completion(
+            model="gpt-4o",
+            temperature=0.7,  # Increased for more creative responses
+            messages=messages,
+            tools=tools,
+            tool_choice={"type": "function", "function": {"name": tools[0]["function"]["name"]}}
+        )
+
+    tool_calls = response.choices[0].message.tool_calls
+    return tool_calls[0].function.arguments if tool_calls else None
+
+async def stream_tool(messages, tools):
+    """Same as call_tool, but yields the raw tool arguments as they are generated"""
+    async with llm_semaphore:
+        stream = await create_chat_completion(
+            model="gpt-4o",
+            temperature=0.7,  # Increased for more creative responses
+            messages=messages,
+            tools=tools,
+            tool_choice={"type": "function", "function": {"name": tools[0]["function"]["name"]}},
+            stream=True
+        )
+
+        # Closed when the caller stops early too, otherwise OpenAI keeps generating the abandoned completion
+        async with stream:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.tool_calls:
+                    arguments = chunk.choices[0].delta.tool_calls[0].function.arguments
+                    if arguments:
+                        yield arguments
+
+class DayStreamParser:
+    """Incrementally parse streamed tool arguments, returning each itinerary day once its JSON object is complete"""
+
+    def __init__(self):
+        self.buffer = ""
+        self.brackets = []
+        self.in_string = False
+        self.escaped = False
+        self.day_start = None
+
+    def feed(self, arguments):
+        days = []
+        offset = len(self.buffer)
+        self.buffer += arguments
+
+        for i, char in enumerate(arguments, offset):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                # Days are the objects directly inside the top level "itinerary" array
+                if char == "{" and self.brackets == ["{", "["]:
+                    self.day_start = i
+                self.brackets.append(char)
+            elif char in "}]":
+                self.brackets.pop()
+                if char == "}" and self.brackets == ["{", "["] and self.day_start is not None:
+                    day = self.buffer[self.day_start:i + 1]
+                    self.day_start = None
+                    try:
+                        days.append(orjson.loads(day))
+                    except orjson.JSONDecodeError as e:
+                        # Skipped, parsing the whole buffer once the stream ends decides what becomes of the plan
+                        logger.error("JSON Decode Error", extra={"error": str(e), "arguments": day})
+
+        return days
+
+def sse_event(event, data):
+    """Format a server-sent event"""
+    return f"event: {event}\ndata: ".encode() + orjson.dumps(data) + b"\n\n"
+
+DAILY_ITINERARY_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "day": {"type": "string"},
+            "details": {
+                "type": "object",
+                "properties": {
+                    "morning": {"type": "string"},
+                    "afternoon": {"type": "string"},
+                    "evening": {"type": "string"},
+                    "meals": {"type": "string"},
+                    "estimated_costs": {
                         "type": "object",
                         "properties": {
-                            "day": {"type": "string"},
-                            "details": {
-                                "type": "object",
-                                "properties": {
-                                    "morning": {"type": "string"},
-                                    "afternoon": {"type": "string"},
-                                    "evening": {"type": "string"},
-                                    "meals": {"type": "string"},
-                                    "estimated_costs": {"type": "string"}
-                                }
-                            }
-                        }
+                            "stay": {"type": "number"},
+                            "transportation": {"type": "number"},
+                            "meals": {"type": "number"},
+                            "misc": {"type": "number"}
+                        },
+                        "required": ["stay", "transportation", "meals", "misc"]
                     }
                 }
+            }
+        }
+    }
+}
+
+# The tools and system messages are the same for every request, so they are only built once
+CREATE_TRIP_PLAN_TOOLS = [{
+    "type": "function",
+    "function": {
+        "name": "create_trip_plan",
+        "description": "Create detailed daily itinerary",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "itinerary": DAILY_ITINERARY_SCHEMA
             },
             "required": ["itinerary"]
         }
     }
-    ]
-
-    try:
-        response = chat_model.invoke(
-            messages,
-            functions=functions,
-            function_call={"name": "create_daily_itinerary"}
-        )
-    except Exception as e:
-        print(f"LangChain invoke error: {e}")
-        return jsonify({"error": "Internal error in AI model invocation"}), 500
-
-    if response.additional_kwargs.get("function_call"):
-        try:
-            function_args = json.loads(response.additional_kwargs["function_call"]["arguments"])
-            return function_args["itinerary"]
-        except json.JSONDecodeError as e:
-            print(f"JSON Decode Error: {e}")
-            print("Response text: " + str(response.additional_kwargs["function_call"]["arguments"]))
-
-    return []
+}]
 
-def calculate_total_cost(itinerary):
-    """calculate total trip costs using the model generated itinerary"""
-    messages = [
-        SystemMessage(content="You are a trip cost calculator. Calculate the total trip cost using the itinerary provided"),
-        HumanMessage(content=f"Itinerary:{itinerary}")
-    ]
-
-    functions = [
-    {
-        "name": "total_costs_calculator",
-        "description": "calculate the total costs based on detailed daily itinerary",
+UPDATE_TRIP_PLAN_TOOLS = [{
+    "type": "function",
+    "function": {
+        "name": "update_trip_plan",
+        "description": "Update the daily itinerary and the title if needed",
         "parameters": {
             "type": "object",
             "properties": {
-                "itinerary_costs": {
-                    "type": "object",
-                    "properties": {
-                        "total_stay_costs": {"type": "string"},
-                        "total_transportation_costs": {"type": "string"},
-                        "total_meal_costs": {"type": "string"},
-                        "total_miscellaneous_costs": {"type": "string"},
-                        "total_trip_cost":{"type": "string"},
-                    }
-                }
+                "itinerary": DAILY_ITINERARY_SCHEMA,
+                "title": {"type": "string"}
             },
-            "required": ["itinerary_costs"]
+            "required": ["itinerary", "title"]
         }
-    },    
+    }
+}]
+
+# The instructions are the same for every trip so they go in the system message, which makes them part of the
+# static prompt prefix (tools and system message) OpenAI caches across requests
+TRIP_PLANNER_SYSTEM_MESSAGE = {"role": "system", "content": textwrap.dedent("""
+    You are a knowledgeable travel planner. Create detailed, realistic daily itineraries that fit the budget and preferences specified.
+
+    For each day, provide:
+    1. Morning activities, MUST provide transportation details for each activity(for example, taxi to Airbnb address), includes estimated transportation time; if theme is not general and the activity is related to the theme, MUST provide the details of how the activities related to the theme.
+    2. Afternoon activities, MUST provide transportation details for each activity(for example, taxi to Airbnb address), includes estimated transportation time; if theme is not general and the activity is related to the theme, MUST provide the details of how the activities related to the theme.
+    3. Evening activities, MUST provide transportation details for each activity(for example, subway to dinning address), includes estimated transportation time; if theme is not general and the activity is related to the theme, MUST provide the details of how the activities related to the theme.
+    4. Recommended restaurants/meals
+    5. Estimated costs, must includes stay(hotel/airbnb) costs, transportation costs, meal costs and miscellaneous costs, as numbers in the trip currency.
+
+    Return the day-by-day itinerary in 'itinerary', where each element has 'day' and 'details' keys.
+    """).strip()}
+TRIP_UPDATER_SYSTEM_MESSAGE = {"role": "system", "content": "You are a travel assistant. Update the provided itinerary and its title based on user suggestions while maintaining the same structure and level of detail."}
+
+# Trip total costs, and the daily estimated costs they add up
+COST_CATEGORIES = {
+    "total_stay_costs": "stay",
+    "total_transportation_costs": "transportation",
+    "total_meal_costs": "meals",
+    "total_miscellaneous_costs": "misc"
+}
+
+# Filled in with the trip details, the missing ones are left empty
+TRIP_DETAILS_PROMPT = textwrap.dedent("""
+    Create a detailed day-by-day itinerary for a {days}-day trip:
+    - From: {origin}
+    - To: {destinations}
+    - Budget: {budget} {currency}
+    - Stay Preference: {stayPref}
+    - Group Size: {groupSize}
+    - Comfort Level: {comfortLevel}
+    - Theme: {theme}
+    - Additional Info: {additionalInfo}
+    """).strip()
+
+# Filled in with the user suggestion and the current itinerary as minified JSON
+UPDATE_ITINERARY_PROMPT = textwrap.dedent("""
+    Update this itinerary based on the following suggestion: {user_suggestion}
+
+    Current itinerary:
+    {itinerary}
+
+    Please maintain the same JSON structure but modify the activities and details according to the suggestion.
+    Make sure to keep the same level of detail for transportation, costs, and activities.
+    If the suggestion warrants a change of the title: {title}, generate a new title that reflects the changes, otherwise return the original title.
+    """).strip()
+
+def daily_activities_request(trip_details):
+    """Build the messages and tools asking the LLM for detailed daily activities"""
+    prompt = TRIP_DETAILS_PROMPT.format_map(defaultdict(str, trip_details["details"]))
+
+    messages = [
+        TRIP_PLANNER_SYSTEM_MESSAGE,
+        {"role": "user", "content": prompt}
     ]
 
-    response = chat_model.invoke(
-        messages,
-        functions=functions,
-        function_call={"name": "total_costs_calculator"}
-    )
+    return messages, CREATE_TRIP_PLAN_TOOLS
+
+async def populate_daily_activities(trip_details):
+    """Generate detailed daily activities and their total costs using the LLM"""
+    messages, tools = daily_activities_request(trip_details)
+
+    try:
+        arguments = await call_tool(messages, tools)
+    except Exception as e:
+        logger.error("OpenAI API error", extra={"error": str(e)})
+        raise
+
+    return parse_trip_plan(arguments)
 
-    if response.additional_kwargs.get("function_call"):
+def parse_trip_plan(arguments):
+    """Parse the tool arguments of the trip plan, an empty plan if the model didn't return valid ones"""
+    if arguments:
         try:
-            function_args = json.loads(response.additional_kwargs["function_call"]["arguments"])
-            return function_args["itinerary_costs"]
-        except json.JSONDecodeError as e:
-            print(f"JSON Decode Error: {e}")
-            print("Response text: " + str(response.additional_kwargs["function_call"]["arguments"]))
-    
+            return orjson.loads(arguments)
+        except orjson.JSONDecodeError as e:
+            logger.error("JSON Decode Error", extra={"error": str(e), "arguments": arguments})
+
     return {}
 
+def cost_amount(cost):
+    """Amount of a daily estimated cost; the schema asks for numbers, a string only counts if it holds a single amount"""
+    if isinstance(cost, (int, float)) and not isinstance(cost, bool):
+        return cost
+
+    amounts = re.findall(r"\d+(?:\.\d+)?", str(cost or "").replace(",", ""))
+    if len(amounts) == 1:
+        return float(amounts[0])
+    if amounts:
+        logger.warning("Ambiguous estimated cost", extra={"cost": cost})
+    return 0
+
+def sum_trip_costs(itinerary):
+    """Add up the daily estimated costs of the itinerary into the trip total costs"""
+    itinerary_costs = dict.fromkeys(COST_CATEGORIES, 0)
+    for day in itinerary:
+        estimated_costs = day.get("details", {}).get("estimated_costs")
+        if isinstance(estimated_costs, dict):
+            for total, category in COST_CATEGORIES.items():
+                itinerary_costs[total] += cost_amount(estimated_costs.get(category))
+
+    itinerary_costs = {total: round(amount, 2) for total, amount in itinerary_costs.items()}
+    itinerary_costs["total_trip_cost"] = round(sum(itinerary_costs.values()), 2)
+    return itinerary_costs
+
+def complete_trip_plan(trip_plan):
+    """Return the daily activities of the trip plan along with the trip costs they add up to"""
+    daily_activities = trip_plan.get("itinerary", [])
+    return daily_activities, sum_trip_costs(daily_activities)
+
+async def plan_daily_activities(trip_details):
+    """Generate the daily activities along with the trip costs, unless the same trip was planned recently"""
+    cache_key = trip_cache_key(trip_details)
+    cached = await cache_get(cache_key)
+    if cached:
+        return cached["itinerary"], cached["itinerary_costs"]
+
+    trip_plan = await populate_daily_activities(trip_details)
+    daily_activities, itinerary_costs = complete_trip_plan(trip_plan)
+    if daily_activities:
+        await cache_set(cache_key, {"itinerary": daily_activities, "itinerary_costs": itinerary_costs}, ITINERARY_CACHE_TTL)
+    return daily_activities, itinerary_costs
+
+async def generate_destination_image(destination, image_quality="preview"):
+    """Generate an image of the destination with DALL-E, the image only depends on the destination so it's cached by it"""
+    if not destination:
+        return None
+
+    cache_key = f"img:{image_quality}:{destination.lower()}"
+    cached = await cache_get(cache_key)
+    if cached:
+        return cached
+
+    async with image_semaphore:
+        async for attempt in openai_retrying():
+            with attempt:
+                response = await client.images.generate(
+                    prompt=f"Generate an image related to {destination}",
+                    n=1,
+                    **IMAGE_QUALITIES[image_quality]
+                )
+    image_url = response.data[0].url
+    await cache_set(cache_key, image_url, IMAGE_CACHE_TTL)
+    return image_url
+
+def discard_task(task):
+    """Cancel the task if it's still running, otherwise retrieve its error so it isn't logged as unhandled"""
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled():
+        task.exception()
+
+# The longest trip the generate routes plan, and the size of its itinerary the update route accepts in its prompt
+MAX_TRIP_DAYS = 14
+MAX_ITINERARY_BYTES = 48 * 1024
+
+class ItineraryRequest(BaseModel):
+    """Body of the generate itinerary routes, validated before any LLM call; days and group size are capped to bound its cost"""
+    origin: constr(max_length=100) = ""
+    destinations: conlist(constr(min_length=1, max_length=100), min_length=1, max_length=5)
+    budget: Union[NonNegativeInt, NonNegativeFloat]
+    days: conint(ge=1, le=MAX_TRIP_DAYS) = 5
+    currency: constr(max_length=10) = "USD"
+    groupSize: conint(ge=1, le=20) = 2
+    comfortLevel: constr(max_length=100) = "moderate"
+    theme: constr(max_length=100) = "general"
+    additionalInfo: constr(max_length=1000) = ""
+    stayPref: constr(max_length=200) = "Doesn't matter, base on my budget and comfort level"
+    skip_image: bool = False
+    image_quality: Literal["preview", "hd"] = "preview"
+
+class UpgradeImageRequest(BaseModel):
+    """Body of the upgrade image route"""
+    destination: constr(min_length=1, max_length=100)
+
+class UpdateItineraryRequest(BaseModel):
+    """Body of the update itinerary route; the current itinerary goes into the prompt, so it's capped like a generated one"""
+    current_itinerary: dict = {}
+    user_suggestion: constr(min_length=1, max_length=1000)
+
+    @field_validator("current_itinerary")
+    @classmethod
+    def check_itinerary_size(cls, current_itinerary):
+        days = current_itinerary.get("itinerary", [])
+        if not isinstance(days, list) or len(days) > MAX_TRIP_DAYS:
+            raise ValueError(f"itinerary must be a list of at most {MAX_TRIP_DAYS} days")
+        if len(orjson.dumps(current_itinerary)) > MAX_ITINERARY_BYTES:
+            raise ValueError(f"current_itinerary must be at most {MAX_ITINERARY_BYTES} bytes of JSON")
+        return current_itinerary
+
+def invalid_request_response(error):
+    return jsonify({"error": "Invalid request", "details": error.errors(include_url=False, include_context=False, include_input=False)}), 400
+
+def parse_trip_request(trip_request):
+    """Build the trip details and the initial itinerary structure from the validated request"""
+    # The image is only generated for the first destination, and not at all if the frontend doesn't need it
+    first_destination = trip_request.destinations[0] if not trip_request.skip_image else None
+
+    destinations = ";".join(trip_request.destinations)
+    # Create initial structure
+    trip_details = {
+        "details": {
+            "origin": trip_request.origin,
+            "destinations": destinations,
+            "budget": trip_request.budget,
+            "days": trip_request.days,
+            "currency": trip_request.currency,
+            "groupSize": trip_request.groupSize,
+            "comfortLevel": trip_request.comfortLevel,
+            "theme": trip_request.theme,
+            "additionalInfo": trip_request.additionalInfo,
+            "stayPref": trip_request.stayPref
+        }
+    }
+
+    # Initial itinerary, filled in with the generated activities, costs and image
+    theme = "" if trip_request.theme == "general" else f" {trip_request.theme}"
+    itinerary = {
+        "title": f"{trip_request.days}-Day{theme} Trip from {trip_request.origin} to {destinations}",
+        "details": {
+            "budget": trip_request.budget,
+            "currency": trip_request.currency,
+            "groupSize": trip_request.groupSize,
+            "comfortLevel": trip_request.comfortLevel,
+            "StayPref": trip_request.stayPref,
+            "theme": trip_request.theme,
+            "additionalInfo": trip_request.additionalInfo
+        },
+        "itinerary": [],
+        "itinerary_costs": {},
+        "image": None
+    }
+
+    return trip_details, itinerary, first_destination
+
 @app.route("/generate_itinerary", methods=["POST"])
-def generate_itinerary():
+@rate_limit(10, timedelta(minutes=1))
+async def generate_itinerary():
     try:
-        data = request.get_json()
-        print("Received data:", data)
+        trip_request = ItineraryRequest.model_validate(await request.get_json(silent=True))
+        logger.info("Received request", extra={"payload": trip_request.model_dump(exclude={"additionalInfo"})})
 
-        first_destination = data.get("destinations", [])[0] if data.get("destinations") else None
+        trip_details, itinerary, first_destination = parse_trip_request(trip_request)
 
-        destinations = ";".join(data.get("destinations", [])) if len(data.get("destinations", []))>0 else ""
-        # Create initial structure
-        trip_details = {
-            "details": {
-                "origin": data.get("origin", ""),
-                "destinations": destinations,
-                "budget": data.get("budget", ""),
-                "days": int(data.get("days", 5)),
-                "currency": data.get("currency", "USD"),
-                "groupSize": int(data.get("groupSize", 2)),
-                "comfortLevel": data.get("comfortLevel", "moderate"),
-                "theme": data.get("theme", "general"),
-                "additionalInfo": data.get("additionalInfo", ""),
-                "stayPref": data.get("stayPref", "Doesn't matter, base on my budget and comfort level")
-            }
-        }
+        # Populate daily activities and costs, the image only depends on the destination so generate it meanwhile
+        image_task = asyncio.create_task(generate_destination_image(first_destination, trip_request.image_quality))
+        try:
+            daily_activities, itinerary_costs = await plan_daily_activities(trip_details)
+            image_url = await image_task
+        finally:
+            # The image isn't needed anymore if the planning failed
+            discard_task(image_task)
+        itinerary["itinerary"] = daily_activities
+        itinerary["itinerary_costs"] = itinerary_costs
+        itinerary["image"] = image_url
+
+        logger.info("Generated itinerary", extra={"days": len(itinerary["itinerary"])})
+        return jsonify(itinerary)
 
-        # Generate initial structure
-        itinerary = create_initial_itinerary_structure(
-            origin=trip_details["details"]["origin"],
-            days=trip_details["details"]["days"],
-            destinations=trip_details["details"]["destinations"],
-            budget=trip_details["details"]["budget"],
-            stayPref=trip_details["details"]["stayPref"],
-            currency=trip_details["details"]["currency"],
-            groupSize=trip_details["details"]["groupSize"],
-            comfortLevel=trip_details["details"]["comfortLevel"],
-            theme=trip_details["details"]["theme"],
-            additionalInfo=trip_details["details"]["additionalInfo"],
-        )
+    except ValidationError as e:
+        return invalid_request_response(e)
+    except Exception as e:
+        logger.exception("Request failed")
+        return jsonify({"error": str(e)}), 500
 
-        # Populate daily activities
-        itinerary["itinerary"] = populate_daily_activities(trip_details)
-        itinerary["itinerary_costs"] = calculate_total_cost(itinerary["itinerary"])
-
-        if (first_destination):
-            # Initialize OpenAI client
-            client = OpenAI()
-            # Generate image
-            response = client.images.generate(
-                model="dall-e-3",
-                prompt=f"Generate an image related to {first_destination}",
-                size='1024x1024',
-                quality='standard',
-                n=1
-            )
-            itinerary["image"] = response.data[0].url
-
-        print(itinerary)
-        return jsonify(itinerary)
+@app.route("/generate_itinerary/stream", methods=["POST"])
+@rate_limit(10, timedelta(minutes=1))
+async def stream_itinerary():
+    """Same as generate_itinerary, but streams each day as a server-sent event as soon as it is generated,
+    then the whole itinerary and finally the image once DALL-E returns it"""
+    try:
+        trip_request = ItineraryRequest.model_validate(await request.get_json(silent=True))
+        logger.info("Received request", extra={"payload": trip_request.model_dump(exclude={"additionalInfo"})})
 
+        trip_details, itinerary, first_destination = parse_trip_request(trip_request)
+    except ValidationError as e:
+        return invalid_request_response(e)
     except Exception as e:
-        print(f"Error: {str(e)}")
+        logger.exception("Request failed")
         return jsonify({"error": str(e)}), 500
 
+    async def events():
+        image_task = asyncio.create_task(generate_destination_image(first_destination, trip_request.image_quality))
+        try:
+            cache_key = trip_cache_key(trip_details)
+            cached = await cache_get(cache_key)
+
+            if cached:
+                for day in cached["itinerary"]:
+                    yield sse_event("day", day)
+                itinerary["itinerary"], itinerary["itinerary_costs"] = cached["itinerary"], cached["itinerary_costs"]
+            else:
+                messages, tools = daily_activities_request(trip_details)
+                parser = DayStreamParser()
+
+                # Closed right away if the parser or the client stops the stream, rather than whenever it's garbage collected
+                async with aclosing(stream_tool(messages, tools)) as arguments_stream:
+                    async for arguments in arguments_stream:
+                        for day in parser.feed(arguments):
+                            yield sse_event("day", day)
+
+                itinerary["itinerary"], itinerary["itinerary_costs"] = complete_trip_plan(parse_trip_plan(parser.buffer))
+                if itinerary["itinerary"]:
+                    await cache_set(cache_key, {"itinerary": itinerary["itinerary"], "itinerary_costs": itinerary["itinerary_costs"]}, ITINERARY_CACHE_TTL)
+
+            # The itinerary is useful on its own, so it's sent without waiting for the image
+            logger.info("Generated itinerary", extra={"days": len(itinerary["itinerary"])})
+            yield sse_event("itinerary", itinerary)
+
+            if first_destination:
+                yield sse_event("image", {"url": await image_task})
+
+        except Exception as e:
+            logger.exception("Request failed")
+            yield sse_event("error", {"error": str(e)})
+        finally:
+            # Also reached when the client disconnects, the generator is then cancelled or closed
+            discard_task(image_task)
+
+    response = await make_response(events(), {"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    response.timeout = None  # The LLM can take longer than the default response timeout
+    return response
+
 @app.route("/update_itinerary", methods=["POST"])
-def update_itinerary():
+@rate_limit(20, timedelta(minutes=1))
+async def update_itinerary():
     try:
-        data = request.get_json()
-        current_itinerary = data.get("current_itinerary", {})
-        user_suggestion = data.get("user_suggestion", "")
-
-        prompt = f"""
-        Update this itinerary based on the following suggestion: {user_suggestion}
-        
-        Current itinerary:
-        {json.dumps(current_itinerary, indent=2)}
-        
-        Please maintain the same JSON structure but modify the activities and details according to the suggestion.
-        Make sure to keep the same level of detail for transportation, costs, and activities.
-        """
+        update_request = UpdateItineraryRequest.model_validate(await request.get_json(silent=True))
+        current_itinerary = update_request.current_itinerary
+        user_suggestion = update_request.user_suggestion
+
+        # Minified JSON reads the same to the model in a lot fewer tokens, and the image URL and total costs aren't useful to it
+        prompt_itinerary = {key: value for key, value in current_itinerary.items() if key not in ("image", "itinerary_costs")}
+
+        prompt = UPDATE_ITINERARY_PROMPT.format(
+            user_suggestion=user_suggestion,
+            itinerary=orjson.dumps(prompt_itinerary).decode(),
+            title=current_itinerary.get("title", "")
+        )
 
         messages = [
-            SystemMessage(content="You are a travel assistant. Update the provided itinerary based on user suggestions while maintaining the same structure and level of detail."),
-            HumanMessage(content=prompt)
+            TRIP_UPDATER_SYSTEM_MESSAGE,
+            {"role": "user", "content": prompt}
         ]
 
-        functions = [{
-            "name": "update_daily_itinerary",
-            "description": "Update the daily itinerary",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "itinerary": {
-                        "type": "array",
-                        "items": {
-                            "type": "object",
-                            "properties": {
-                                "day": {"type": "string"},
-                                "details": {
-                                    "type": "object",
-                                    "properties": {
-                                        "morning": {"type": "string"},
-                                        "afternoon": {"type": "string"},
-                                        "evening": {"type": "string"},
-                                        "meals": {"type": "string"},
-                                        "estimated_costs": {"type": "string"}
-                                    }
-                                }
-                            }
-                        }
-                    }
-                },
-                "required": ["itinerary"]
-            }
-        }]
+        arguments = await call_tool(messages, UPDATE_TRIP_PLAN_TOOLS)
 
-        response = chat_model.invoke(
-            messages,
-            functions=functions,
-            function_call={"name": "update_daily_itinerary"}
-        )
-
-        if response.additional_kwargs.get("function_call"):
+        if arguments:
             try:
-                print("Response text: " + str(response.additional_kwargs["function_call"]["arguments"]))
-                function_args = json.loads(response.additional_kwargs["function_call"]["arguments"])
-                 # Update the itinerary
-                current_itinerary["itinerary"] = function_args["itinerary"]
-                
-                # Update the title based on user suggestion
-                title_update_prompt = f"""
-                Based on this user suggestion: {user_suggestion}
-                And the current title: {current_itinerary.get('title', '')}
-                Should the title be updated? If yes, generate a new title that reflects the changes.
-                If no changes are needed, return the original title.
-                """
-                
-                title_messages = [
-                    SystemMessage(content="You are a travel assistant. Help update the trip title if the user's suggestions warrant a change."),
-                    HumanMessage(content=title_update_prompt)
-                ]
-                
-                title_functions = [{
-                    "name": "update_title",
-                    "description": "Update the itinerary title if needed",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "title": {"type": "string"}
-                        },
-                        "required": ["title"]
-                    }
-                }]
-                
-                title_response = chat_model.invoke(
-                    title_messages,
-                    functions=title_functions,
-                    function_call={"name": "update_title"}
-                )
-                
-                if title_response.additional_kwargs.get("function_call"):
-                    try:
-                        print("Response text: " + str(title_response.additional_kwargs["function_call"]["arguments"]))
-                        title_args = json.loads(title_response.additional_kwargs["function_call"]["arguments"])
-                        current_itinerary["title"] = title_args["title"]
-                    except json.JSONDecodeError as e:
-                        print(f"JSON Decode Error: {e}")
-                        print("Response text: " + str(title_response.additional_kwargs["function_call"]["arguments"]))
-
-        
-
-                # Recalculate costs
-                current_itinerary["itinerary_costs"] = calculate_total_cost(current_itinerary["itinerary"])
-                print(current_itinerary["itinerary_costs"])
+                function_args = orjson.loads(arguments)
+                 # Update the itinerary, its costs and title
+                current_itinerary["itinerary"], current_itinerary["itinerary_costs"] = complete_trip_plan(function_args)
+                current_itinerary["title"] = function_args.get("title") or current_itinerary.get("title", "")
+                logger.info("Updated itinerary", extra={"days": len(current_itinerary["itinerary"])})
                 
                 return jsonify(current_itinerary)
-            except json.JSONDecodeError as e:
-                print(f"JSON Decode Error: {e}")
-                print("Response text: " + str(response.additional_kwargs["function_call"]["arguments"]))
+            except orjson.JSONDecodeError as e:
+                logger.error("JSON Decode Error", extra={"error": str(e), "arguments": arguments})
                 return jsonify({"error": "Failed to update itinerary"}), 400
 
+        return jsonify({"error": "Failed to update itinerary"}), 400
+
+    except ValidationError as e:
+        return invalid_request_response(e)
+    except Exception as e:
+        logger.exception("Request failed")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/upgrade_image", methods=["POST"])
+@rate_limit(10, timedelta(minutes=1))
+async def upgrade_image():
+    """Generate the HD image of a destination, for when the user asks for more than the preview"""
+    try:
+        upgrade_request = UpgradeImageRequest.model_validate(await request.get_json(silent=True))
+        image_url = await generate_destination_image(upgrade_request.destination, "hd")
+        return jsonify({"image": image_url})
+
+    except ValidationError as e:
+        return invalid_request_response(e)
     except Exception as e:
-        print(f"Error: {str(e)}")
+        logger.exception("Request failed")
         return jsonify({"error": str(e)}), 500
 
 if __name__ == "__main__":
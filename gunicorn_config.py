@@ -1,6 +1,18 @@
+import multiprocessing
+import os
+
 bind = '0.0.0.0:5000'
-workers = 3
+# The requests are I/O bound and each async worker serves many of them concurrently
+workers = (2 * multiprocessing.cpu_count()) + 1
+worker_class = 'uvicorn.workers.UvicornWorker'
 timeout = 120
+graceful_timeout = 30
+# Longer than the idle timeout of the load balancer in front, so it can keep reusing its connections
+keepalive = 75
+# Only these proxies may set the client address through X-Forwarded-For, the app rate limits clients by it
+forwarded_allow_ips = os.getenv('FORWARDED_ALLOW_IPS', '127.0.0.1')
+# Access logs to stdout, the app logs its own JSON lines to stderr
+accesslog = '-'
 ssl_version = 'TLS'
 keyfile = '/etc/ssl/private/flask-selfsigned.key'
-certfile = '/etc/ssl/certs/flask-selfsigned.crt'
\ No newline at end of file
+certfile = '/etc/ssl/certs/flask-selfsigned.crt'
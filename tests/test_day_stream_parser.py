@@ -0,0 +1,62 @@
+import os
+import unittest
+
+import orjson
+
+# The OpenAI client is created at import time and requires an API key, no call is made by these tests
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from app import DayStreamParser, parse_trip_plan
+
+DAYS = [
+    {"day": "1", "details": {"morning": "Taxi to the \"Louvre\" {museum} [1h]", "estimated_costs": {"stay": 100, "misc": 10}}},
+    {"day": "2", "details": {"morning": "Walk along the Seine \\ Metro", "estimated_costs": {"stay": 100, "misc": 12.5}}}
+]
+ARGUMENTS = orjson.dumps({"itinerary": DAYS}).decode()
+
+def feed_chunks(chunks):
+    parser = DayStreamParser()
+    days = []
+    for chunk in chunks:
+        days.extend(parser.feed(chunk))
+    return parser, days
+
+class DayStreamParserTest(unittest.TestCase):
+
+    def test_whole_arguments(self):
+        parser, days = feed_chunks([ARGUMENTS])
+        self.assertEqual(days, DAYS)
+        self.assertEqual(parse_trip_plan(parser.buffer), {"itinerary": DAYS})
+
+    def test_chunk_boundaries(self):
+        # Every split point, including inside strings, escapes and the brackets around the days
+        for size in (1, 2, 3, 7, 16):
+            chunks = [ARGUMENTS[i:i + size] for i in range(0, len(ARGUMENTS), size)]
+            _, days = feed_chunks(chunks)
+            self.assertEqual(days, DAYS, size)
+
+    def test_escaped_quote_split_from_backslash(self):
+        escape = ARGUMENTS.index('\\"')
+        _, days = feed_chunks([ARGUMENTS[:escape + 1], ARGUMENTS[escape + 1:]])
+        self.assertEqual(days, DAYS)
+
+    def test_day_returned_once_complete(self):
+        end_of_first_day = ARGUMENTS.index(',{"day":"2"')
+        parser = DayStreamParser()
+        self.assertEqual(parser.feed(ARGUMENTS[:end_of_first_day - 1]), [])
+        self.assertEqual(parser.feed(ARGUMENTS[end_of_first_day - 1:end_of_first_day]), DAYS[:1])
+        self.assertEqual(parser.feed(ARGUMENTS[end_of_first_day:]), DAYS[1:])
+
+    def test_malformed_day(self):
+        malformed = ARGUMENTS.replace('"misc":10', '"misc":ten')
+        parser, days = feed_chunks([malformed])
+        self.assertEqual(days, DAYS[1:])
+        self.assertEqual(parse_trip_plan(parser.buffer), {})
+
+    def test_no_tool_call(self):
+        parser, days = feed_chunks([])
+        self.assertEqual(days, [])
+        self.assertEqual(parse_trip_plan(parser.buffer), {})
+
+if __name__ == "__main__":
+    unittest.main()
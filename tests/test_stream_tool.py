@@ -0,0 +1,66 @@
+import asyncio
+import os
+import unittest
+from contextlib import aclosing
+from types import SimpleNamespace
+from unittest import mock
+
+# The OpenAI client is created at import time and requires an API key, no call is made by these tests
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import app
+
+def arguments_chunk(arguments):
+    tool_call = SimpleNamespace(function=SimpleNamespace(arguments=arguments))
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(tool_calls=[tool_call]))])
+
+class FakeStream:
+    """Stands in for the AsyncStream of a streamed completion, the second chunk never arrives"""
+
+    def __init__(self):
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.closed = True
+
+    async def __aiter__(self):
+        yield arguments_chunk('{"itinerary": [')
+        await asyncio.Event().wait()
+
+class StreamToolTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.stream = FakeStream()
+        patcher = mock.patch.object(app, "create_chat_completion", mock.AsyncMock(return_value=self.stream))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_consumer_cancelled_mid_stream(self):
+        received = []
+
+        async def consume():
+            async for arguments in app.stream_tool([], app.CREATE_TRIP_PLAN_TOOLS):
+                received.append(arguments)
+
+        task = asyncio.create_task(consume())
+        while not received:
+            await asyncio.sleep(0)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+        self.assertTrue(self.stream.closed)
+
+    async def test_consumer_stops_early(self):
+        with self.assertRaises(ValueError):
+            async with aclosing(app.stream_tool([], app.CREATE_TRIP_PLAN_TOOLS)) as arguments_stream:
+                async for arguments in arguments_stream:
+                    raise ValueError(arguments)
+
+        self.assertTrue(self.stream.closed)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import os
+import unittest
+
+# The OpenAI client is created at import time and requires an API key, no call is made by these tests
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from app import cost_amount, sum_trip_costs
+
+class TripCostsTest(unittest.TestCase):
+
+    def test_sum_trip_costs(self):
+        itinerary = [
+            {"day": "1", "details": {"estimated_costs": {"stay": 100, "transportation": 20.5, "meals": 40, "misc": 10}}},
+            {"day": "2", "details": {"estimated_costs": {"stay": 100, "transportation": 20.25, "meals": "$1,040", "misc": None}}}
+        ]
+        self.assertEqual(sum_trip_costs(itinerary), {
+            "total_stay_costs": 200,
+            "total_transportation_costs": 40.75,
+            "total_meal_costs": 1080.0,
+            "total_miscellaneous_costs": 10,
+            "total_trip_cost": 1330.75
+        })
+
+    def test_days_without_estimated_costs(self):
+        itinerary = [{"day": "1", "details": {}}, {"day": "2", "details": {"estimated_costs": "Stay: $100"}}]
+        self.assertEqual(sum_trip_costs(itinerary)["total_trip_cost"], 0)
+
+    def test_ambiguous_string_amount(self):
+        self.assertEqual(cost_amount("USD 60.5"), 60.5)
+        self.assertEqual(cost_amount("2 nights at 60"), 0)
+        self.assertEqual(cost_amount(True), 0)
+
+if __name__ == "__main__":
+    unittest.main()